@@ -24,14 +24,16 @@ import (
 	"net"
 	"os"
 	"path/filepath"
+	"reflect"
 	"regexp"
 	"strconv"
 	"strings"
+	"sync"
 
+	"github.com/containernetworking/cni/pkg/invoke"
 	"github.com/containernetworking/cni/pkg/skel"
 	cnitypes "github.com/containernetworking/cni/pkg/types"
 	"github.com/containernetworking/cni/pkg/types/current"
-	"github.com/containernetworking/plugins/pkg/ipam"
 	"github.com/sirupsen/logrus"
 	lumberjack "gopkg.in/natefinch/lumberjack.v2"
 
@@ -40,6 +42,7 @@ import (
 	"github.com/projectcalico/libcalico-go/lib/apiconfig"
 	api "github.com/projectcalico/libcalico-go/lib/apis/v3"
 	client "github.com/projectcalico/libcalico-go/lib/clientv3"
+	cerrors "github.com/projectcalico/libcalico-go/lib/errors"
 	"github.com/projectcalico/libcalico-go/lib/names"
 	cnet "github.com/projectcalico/libcalico-go/lib/net"
 	"github.com/projectcalico/libcalico-go/lib/options"
@@ -68,7 +71,7 @@ func DetermineNodename(conf types.NetConf) (nodename string) {
 		nodename = conf.Hostname
 		logrus.Warn("Configuration option 'hostname' is deprecated, use 'nodename' instead")
 	} else {
-		nodename, _ = names.Hostname()
+		nodename = osHostname()
 		logrus.Debugf("Read node name from OS Hostname")
 	}
 
@@ -76,12 +79,37 @@ func DetermineNodename(conf types.NetConf) (nodename string) {
 	return
 }
 
+var (
+	osHostnameOnce sync.Once
+	osHostnameVal  string
+)
+
+// osHostname returns the OS hostname, looking it up at most once per process.
+func osHostname() string {
+	osHostnameOnce.Do(func() {
+		osHostnameVal, _ = names.Hostname()
+	})
+	return osHostnameVal
+}
+
+// nodenameFiles caches the contents of nodename files already read by this process, so that
+// the calico-ipam code running in-process doesn't re-read the file the plugin has just read.
+var (
+	nodenameFilesLock sync.Mutex
+	nodenameFiles     = map[string]string{}
+)
+
 // nodenameFromFile reads the /var/lib/calico/nodename file if it exists and
 // returns the nodename within.
 func nodenameFromFile(filename string) string {
 	if filename == "" {
 		filename = "/var/lib/calico/nodename"
 	}
+	nodenameFilesLock.Lock()
+	defer nodenameFilesLock.Unlock()
+	if nodename, ok := nodenameFiles[filename]; ok {
+		return nodename
+	}
 	data, err := ioutil.ReadFile(filename)
 	if err != nil {
 		if os.IsNotExist(err) {
@@ -92,6 +120,7 @@ func nodenameFromFile(filename string) string {
 		logrus.WithError(err).Errorf("Failed to read %s", filename)
 		return ""
 	}
+	nodenameFiles[filename] = string(data)
 	return string(data)
 }
 
@@ -124,6 +153,79 @@ func CreateOrUpdate(ctx context.Context, client client.Interface, wep *api.Workl
 	return client.WorkloadEndpoints().Create(ctx, wep, options.SetOptions{})
 }
 
+// CreateProfile creates the given profile. A profile that already exists is treated as success, since another
+// ADD on the same network may have created it after the caller checked for it.
+func CreateProfile(ctx context.Context, c client.Interface, profile *api.Profile) error {
+	if _, err := c.Profiles().Create(ctx, profile, options.SetOptions{}); err != nil {
+		if _, ok := err.(cerrors.ErrorResourceAlreadyExists); !ok {
+			return err
+		}
+		logrus.Infof("Profile %s was created concurrently", profile.Name)
+	}
+	return nil
+}
+
+// CalicoIPAMAdd and CalicoIPAMDel, if set, perform a calico-ipam ADD or DEL within the current process.
+// The Calico CNI plugin is built into the same binary as calico-ipam, so it sets these to avoid executing
+// the calico-ipam binary and parsing its output.
+var (
+	CalicoIPAMAdd func(args *skel.CmdArgs) (*current.Result, error)
+	CalicoIPAMDel func(args *skel.CmdArgs) error
+)
+
+// ExecAddIPAM calls the configured IPAM plugin's ADD, calling calico-ipam in-process when possible.
+func ExecAddIPAM(conf types.NetConf, args *skel.CmdArgs) (cnitypes.Result, error) {
+	if conf.IPAM.Type == "calico-ipam" && CalicoIPAMAdd != nil {
+		result, err := CalicoIPAMAdd(args)
+		if err != nil {
+			return nil, err
+		}
+		return result, nil
+	}
+	pluginPath, err := findIPAMPlugin(conf.IPAM.Type)
+	if err != nil {
+		return nil, err
+	}
+	return invoke.ExecPluginWithResult(context.TODO(), pluginPath, args.StdinData, &invoke.DelegateArgs{Command: "ADD"}, nil)
+}
+
+// execDelIPAM calls the configured IPAM plugin's DEL, calling calico-ipam in-process when possible.
+func execDelIPAM(conf types.NetConf, args *skel.CmdArgs) error {
+	if conf.IPAM.Type == "calico-ipam" && CalicoIPAMDel != nil {
+		return CalicoIPAMDel(args)
+	}
+	pluginPath, err := findIPAMPlugin(conf.IPAM.Type)
+	if err != nil {
+		return err
+	}
+	return invoke.ExecPluginWithoutResult(context.TODO(), pluginPath, args.StdinData, &invoke.DelegateArgs{Command: "DEL"}, nil)
+}
+
+// ipamPluginPaths caches the location of each IPAM plugin found on CNI_PATH, keyed by plugin name and search path.
+var (
+	ipamPluginPathsLock sync.Mutex
+	ipamPluginPaths     = map[string]string{}
+)
+
+// findIPAMPlugin returns the location of the named IPAM plugin on CNI_PATH. Results are cached so that
+// repeated IPAM calls within a single invocation (such as releasing an allocation after a failed ADD)
+// don't rescan the search path.
+func findIPAMPlugin(plugin string) (string, error) {
+	cniPath := os.Getenv("CNI_PATH")
+	key := plugin + string(os.PathListSeparator) + cniPath
+	ipamPluginPathsLock.Lock()
+	defer ipamPluginPathsLock.Unlock()
+	if pluginPath, ok := ipamPluginPaths[key]; ok {
+		return pluginPath, nil
+	}
+	pluginPath, err := invoke.FindInPath(plugin, filepath.SplitList(cniPath))
+	if err != nil {
+		return "", err
+	}
+	ipamPluginPaths[key] = pluginPath
+	return pluginPath, nil
+}
+
 // AddIPAM calls through to the configured IPAM plugin.
 // It also contains IPAM plugin specific logic based on the configured plugin.
 func AddIPAM(conf types.NetConf, args *skel.CmdArgs, logger *logrus.Entry) (*current.Result, error) {
@@ -144,7 +246,7 @@ func AddIPAM(conf types.NetConf, args *skel.CmdArgs, logger *logrus.Entry) (*cur
 
 	// Actually call the IPAM plugin.
 	logger.Debugf("Calling IPAM plugin %s", conf.IPAM.Type)
-	ipamResult, err := ipam.ExecAdd(conf.IPAM.Type, args.StdinData)
+	ipamResult, err := ExecAddIPAM(conf, args)
 	if err != nil {
 		return nil, err
 	}
@@ -246,7 +348,7 @@ func DeleteIPAM(conf types.NetConf, args *skel.CmdArgs, logger *logrus.Entry) er
 	}
 
 	// Call the CNI plugin.
-	err := ipam.ExecDel(conf.IPAM.Type, args.StdinData)
+	err := execDelIPAM(conf, args)
 	if err != nil {
 		logger.Error(err)
 	} else if ae != nil {
@@ -457,41 +559,42 @@ func validateRangeOrSetDefault(rangeData string, expRange string, ipnet *net.IPN
 
 }
 
+// networkNameRegex matches the network names that felix accepts.
+var networkNameRegex = regexp.MustCompile(`^[a-zA-Z0-9_\.\-]+$`)
+
 // ValidateNetworkName checks that the network name meets felix's expectations
 func ValidateNetworkName(name string) error {
-	matched, err := regexp.MatchString(`^[a-zA-Z0-9_\.\-]+$`, name)
-	if err != nil {
-		return err
-	}
-	if !matched {
+	if !networkNameRegex.MatchString(name) {
 		return errors.New("invalid characters detected in the given network name. " +
 			"Only letters a-z, numbers 0-9, and symbols _.- are supported")
 	}
 	return nil
 }
 
+// Regular expressions used to sanitize mesos labels. Inspired by:
+// https://github.com/projectcalico/libcalico-go/blob/2ff29bed865c4b364d4fcf1ad214b2bd8d9b4afa/lib/upgrade/converters/names.go#L39-L58
+var (
+	mesosInvalidChar               = regexp.MustCompile("[^-_.a-zA-Z0-9]+")
+	mesosDotDashSeq                = regexp.MustCompile("[.-]*[.][.-]*")
+	mesosTrailingLeadingDotsDashes = regexp.MustCompile("^[.-]*(.*?)[.-]*$")
+)
+
 // SanitizeMesosLabel converts a string from a valid mesos label to a valid Calico label.
 // Mesos labels have no restriction outside of being unicode.
 func SanitizeMesosLabel(s string) string {
-	// Inspired by:
-	// https://github.com/projectcalico/libcalico-go/blob/2ff29bed865c4b364d4fcf1ad214b2bd8d9b4afa/lib/upgrade/converters/names.go#L39-L58
-	invalidChar := regexp.MustCompile("[^-_.a-zA-Z0-9]+")
-	dotDashSeq := regexp.MustCompile("[.-]*[.][.-]*")
-	trailingLeadingDotsDashes := regexp.MustCompile("^[.-]*(.*?)[.-]*$")
-
 	// -  Convert [/] to .
 	s = strings.Replace(s, "/", ".", -1)
 
 	// -  Convert any other invalid chars
-	s = invalidChar.ReplaceAllString(s, "-")
+	s = mesosInvalidChar.ReplaceAllString(s, "-")
 
 	// Convert any multi-byte sequence of [-.] with at least one [.] to a single .
-	s = dotDashSeq.ReplaceAllString(s, ".")
+	s = mesosDotDashSeq.ReplaceAllString(s, ".")
 
 	// Extract the trailing and leading dots and dashes.   This should always match even if
 	// the matched substring is empty.  The second item in the returned submatch
 	// slice is the captured match group.
-	submatches := trailingLeadingDotsDashes.FindStringSubmatch(s)
+	submatches := mesosTrailingLeadingDotsDashes.FindStringSubmatch(s)
 	s = submatches[1]
 	return s
 }
@@ -500,8 +603,8 @@ func SanitizeMesosLabel(s string) string {
 // complain about the Kubernetes arguments. See https://github.com/kubernetes/kubernetes/pull/24983
 func AddIgnoreUnknownArgs() error {
 	cniArgs := "IgnoreUnknown=1"
-	if os.Getenv("CNI_ARGS") != "" {
-		cniArgs = fmt.Sprintf("%s;%s", cniArgs, os.Getenv("CNI_ARGS"))
+	if existing := os.Getenv("CNI_ARGS"); existing != "" {
+		cniArgs += ";" + existing
 	}
 	return os.Setenv("CNI_ARGS", cniArgs)
 }
@@ -563,13 +666,20 @@ type WEPIdentifiers struct {
 // GetIdentifiers takes CNI command arguments, and extracts identifiers i.e. pod name, pod namespace,
 // container ID, endpoint(container interface name) and orchestratorID based on the orchestrator.
 func GetIdentifiers(args *skel.CmdArgs, nodename string) (*WEPIdentifiers, error) {
-	// Determine if running under k8s by checking the CNI args
-	k8sArgs := types.K8sArgs{}
+	// Determine if running under k8s by checking the CNI args. The CNI test args are loaded in the
+	// same pass so that CNI_ARGS only needs to be parsed once. CNI_TEST_NAMESPACE is therefore accepted
+	// alongside the k8s args, but it's only used for non-k8s workloads. types.CNITestArgs can't be embedded
+	// here as well, because it would make the IgnoreUnknown field of their shared CommonArgs ambiguous.
+	// Warning: CNI_TEST_NAMESPACE is used for test purpose only and subject to change without prior notice.
+	k8sArgs := struct {
+		types.K8sArgs
+		CNI_TEST_NAMESPACE cnitypes.UnmarshallableString
+	}{}
 	if err := cnitypes.LoadArgs(args.Args, &k8sArgs); err != nil {
 		return nil, err
 	}
 	logrus.Debugf("Getting WEP identifiers with arguments: %s, for node %s", args.Args, nodename)
-	logrus.Debugf("Loaded k8s arguments: %v", k8sArgs)
+	logrus.Debugf("Loaded k8s arguments: %v", k8sArgs.K8sArgs)
 
 	epIDs := WEPIdentifiers{}
 	epIDs.ContainerID = args.ContainerID
@@ -587,13 +697,9 @@ func GetIdentifiers(args *skel.CmdArgs, nodename string) (*WEPIdentifiers, error
 		// For any non-k8s orchestrator we set the namespace to default.
 		epIDs.Namespace = "default"
 
-		// Warning: CNITestArgs is used for test purpose only and subject to change without prior notice.
-		CNITestArgs := types.CNITestArgs{}
-		if err := cnitypes.LoadArgs(args.Args, &CNITestArgs); err == nil {
-			// Set namespace with the value passed by CNI test args.
-			if string(CNITestArgs.CNI_TEST_NAMESPACE) != "" {
-				epIDs.Namespace = string(CNITestArgs.CNI_TEST_NAMESPACE)
-			}
+		// Set namespace with the value passed by CNI test args.
+		if string(k8sArgs.CNI_TEST_NAMESPACE) != "" {
+			epIDs.Namespace = string(k8sArgs.CNI_TEST_NAMESPACE)
 		}
 	}
 
@@ -601,17 +707,28 @@ func GetIdentifiers(args *skel.CmdArgs, nodename string) (*WEPIdentifiers, error
 }
 
 func GetHandleID(netName, containerID, workload string) string {
-	handleID := fmt.Sprintf("%s.%s", netName, containerID)
-
-	logrus.WithFields(logrus.Fields{
-		"HandleID":    handleID,
-		"Network":     netName,
-		"Workload":    workload,
-		"ContainerID": containerID,
-	}).Debug("Generated IPAM handle")
+	handleID := netName + "." + containerID
+
+	// Avoid building the fields map unless it's going to be logged.
+	if logrus.IsLevelEnabled(logrus.DebugLevel) {
+		logrus.WithFields(logrus.Fields{
+			"HandleID":    handleID,
+			"Network":     netName,
+			"Workload":    workload,
+			"ContainerID": containerID,
+		}).Debug("Generated IPAM handle")
+	}
 	return handleID
 }
 
+// The Calico client is cached for the lifetime of the process so that repeated callers
+// share a single datastore connection rather than opening a new one each time.
+var (
+	clientLock       sync.Mutex
+	cachedClient     client.Interface
+	cachedClientSpec apiconfig.CalicoAPIConfigSpec
+)
+
 func CreateClient(conf types.NetConf) (client.Interface, error) {
 	if err := ValidateNetworkName(conf.Name); err != nil {
 		return nil, err
@@ -619,60 +736,31 @@ func CreateClient(conf types.NetConf) (client.Interface, error) {
 
 	// Use the config file to override environment variables.
 	// These variables will be loaded into the client config.
-	if conf.EtcdAuthority != "" {
-		if err := os.Setenv("ETCD_AUTHORITY", conf.EtcdAuthority); err != nil {
-			return nil, err
-		}
-	}
-	if conf.EtcdEndpoints != "" {
-		if err := os.Setenv("ETCD_ENDPOINTS", conf.EtcdEndpoints); err != nil {
-			return nil, err
-		}
-	}
-	if conf.EtcdDiscoverySrv != "" {
-		if err := os.Setenv("ETCD_DISCOVERY_SRV", conf.EtcdDiscoverySrv); err != nil {
-			return nil, err
-		}
-	}
-	if conf.EtcdScheme != "" {
-		if err := os.Setenv("ETCD_SCHEME", conf.EtcdScheme); err != nil {
-			return nil, err
-		}
-	}
-	if conf.EtcdKeyFile != "" {
-		if err := os.Setenv("ETCD_KEY_FILE", conf.EtcdKeyFile); err != nil {
-			return nil, err
-		}
-	}
-	if conf.EtcdCertFile != "" {
-		if err := os.Setenv("ETCD_CERT_FILE", conf.EtcdCertFile); err != nil {
-			return nil, err
-		}
-	}
-	if conf.EtcdCaCertFile != "" {
-		if err := os.Setenv("ETCD_CA_CERT_FILE", conf.EtcdCaCertFile); err != nil {
-			return nil, err
-		}
-	}
-	if conf.DatastoreType != "" {
-		if err := os.Setenv("DATASTORE_TYPE", conf.DatastoreType); err != nil {
-			return nil, err
-		}
-	}
-
-	// Set Kubernetes specific variables for use with the Kubernetes libcalico backend.
-	if conf.Kubernetes.Kubeconfig != "" {
-		if err := os.Setenv("KUBECONFIG", conf.Kubernetes.Kubeconfig); err != nil {
-			return nil, err
-		}
-	}
-	if conf.Kubernetes.K8sAPIRoot != "" {
-		if err := os.Setenv("K8S_API_ENDPOINT", conf.Kubernetes.K8sAPIRoot); err != nil {
-			return nil, err
-		}
-	}
-	if conf.Policy.K8sAuthToken != "" {
-		if err := os.Setenv("K8S_API_TOKEN", conf.Policy.K8sAuthToken); err != nil {
+	var envOverrides = []struct {
+		variable string
+		value    string
+	}{
+		{"ETCD_AUTHORITY", conf.EtcdAuthority},
+		{"ETCD_ENDPOINTS", conf.EtcdEndpoints},
+		{"ETCD_DISCOVERY_SRV", conf.EtcdDiscoverySrv},
+		{"ETCD_SCHEME", conf.EtcdScheme},
+		{"ETCD_KEY_FILE", conf.EtcdKeyFile},
+		{"ETCD_CERT_FILE", conf.EtcdCertFile},
+		{"ETCD_CA_CERT_FILE", conf.EtcdCaCertFile},
+		{"DATASTORE_TYPE", conf.DatastoreType},
+
+		// Kubernetes specific variables for use with the Kubernetes libcalico backend.
+		{"KUBECONFIG", conf.Kubernetes.Kubeconfig},
+		{"K8S_API_ENDPOINT", conf.Kubernetes.K8sAPIRoot},
+		{"K8S_API_TOKEN", conf.Policy.K8sAuthToken},
+	}
+
+	// Using the override table above, export any non-empty values.
+	for _, override := range envOverrides {
+		if override.value == "" {
+			continue
+		}
+		if err := os.Setenv(override.variable, override.value); err != nil {
 			return nil, err
 		}
 	}
@@ -683,11 +771,20 @@ func CreateClient(conf types.NetConf) (client.Interface, error) {
 		return nil, err
 	}
 
+	clientLock.Lock()
+	defer clientLock.Unlock()
+	if cachedClient != nil && reflect.DeepEqual(cachedClientSpec, clientConfig.Spec) {
+		logrus.Debug("Reusing existing Calico client")
+		return cachedClient, nil
+	}
+
 	// Create a new client.
 	calicoClient, err := client.New(*clientConfig)
 	if err != nil {
 		return nil, err
 	}
+	cachedClient = calicoClient
+	cachedClientSpec = clientConfig.Spec
 	return calicoClient, nil
 }
 
@@ -761,11 +858,9 @@ func ConfigureLogging(conf types.NetConf) {
 
 // ResolvePools takes an array of CIDRs or IP Pool names and resolves it to a slice of pool CIDRs.
 func ResolvePools(ctx context.Context, c client.Interface, pools []string, isv4 bool) ([]cnet.IPNet, error) {
-	// First, query all IP pools. We need these so we can resolve names to CIDRs.
-	pl, err := c.IPPools().List(ctx, options.ListOptions{})
-	if err != nil {
-		return nil, err
-	}
+	// The IP pools are only needed to resolve names to CIDRs, so we query them lazily,
+	// at most once, the first time we come across something that isn't a CIDR.
+	var pl *api.IPPoolList
 
 	// Iterate through the provided pools. If it parses as a CIDR, just use that.
 	// If it does not parse as a CIDR, then attempt to lookup an IP pool with a matching name.
@@ -773,6 +868,14 @@ func ResolvePools(ctx context.Context, c client.Interface, pools []string, isv4
 	for _, p := range pools {
 		_, cidr, err := net.ParseCIDR(p)
 		if err != nil {
+			if pl == nil {
+				var listErr error
+				pl, listErr = c.IPPools().List(ctx, options.ListOptions{})
+				if listErr != nil {
+					return nil, listErr
+				}
+			}
+
 			// Didn't parse as a CIDR - check if it's the name
 			// of a configured IP pool.
 			for _, ipp := range pl.Items {
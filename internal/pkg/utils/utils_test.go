@@ -1,13 +1,63 @@
 package utils_test
 
 import (
+	"context"
+	"errors"
+
+	"github.com/containernetworking/cni/pkg/skel"
 	. "github.com/onsi/ginkgo"
 	"github.com/onsi/ginkgo/extensions/table"
 	. "github.com/onsi/gomega"
 
 	"github.com/projectcalico/cni-plugin/internal/pkg/utils"
+	api "github.com/projectcalico/libcalico-go/lib/apis/v3"
+	client "github.com/projectcalico/libcalico-go/lib/clientv3"
+	cerrors "github.com/projectcalico/libcalico-go/lib/errors"
+	"github.com/projectcalico/libcalico-go/lib/options"
 )
 
+// fakeClient is a Calico client that only implements the calls made by the code under test.
+type fakeClient struct {
+	client.Interface
+	profiles *fakeProfiles
+	ipPools  *fakeIPPools
+}
+
+func (c fakeClient) Profiles() client.ProfileInterface {
+	return c.profiles
+}
+
+func (c fakeClient) IPPools() client.IPPoolInterface {
+	return c.ipPools
+}
+
+// fakeProfiles counts profile creations, failing each with createErr if it's set.
+type fakeProfiles struct {
+	client.ProfileInterface
+	createErr error
+	creates   int
+}
+
+func (p *fakeProfiles) Create(ctx context.Context, res *api.Profile, opts options.SetOptions) (*api.Profile, error) {
+	p.creates++
+	if p.createErr != nil {
+		return nil, p.createErr
+	}
+	return res, nil
+}
+
+// fakeIPPools serves a fixed list of IP pools and counts the List calls.
+type fakeIPPools struct {
+	client.IPPoolInterface
+	items []api.IPPool
+	lists int
+}
+
+func (p *fakeIPPools) List(ctx context.Context, opts options.ListOptions) (*api.IPPoolList, error) {
+	p.lists++
+	return &api.IPPoolList{Items: p.items}, nil
+}
+
 var _ = Describe("utils", func() {
 	table.DescribeTable("Mesos Labels", func(raw, sanitized string) {
 		result := utils.SanitizeMesosLabel(raw)
@@ -21,4 +71,102 @@ var _ = Describe("utils", func() {
 		table.Entry("mix of special chars",
 			"some_val-with.lots*of^weird#characters", "some_val-with.lots-of-weird-characters"),
 	)
+
+	table.DescribeTable("GetIdentifiers", func(cniArgs, orchestrator, namespace, pod string) {
+		args := &skel.CmdArgs{ContainerID: "abc123", IfName: "eth0", Args: cniArgs}
+		epIDs, err := utils.GetIdentifiers(args, "node1")
+		Expect(err).NotTo(HaveOccurred())
+		Expect(epIDs.Orchestrator).To(Equal(orchestrator))
+		Expect(epIDs.Namespace).To(Equal(namespace))
+		Expect(epIDs.Pod).To(Equal(pod))
+		Expect(epIDs.ContainerID).To(Equal("abc123"))
+		Expect(epIDs.Endpoint).To(Equal("eth0"))
+		Expect(epIDs.Node).To(Equal("node1"))
+	},
+		table.Entry("k8s", "IgnoreUnknown=1;K8S_POD_NAMESPACE=ns1;K8S_POD_NAME=pod1", "k8s", "ns1", "pod1"),
+		table.Entry("k8s ignores the test namespace",
+			"K8S_POD_NAMESPACE=ns1;K8S_POD_NAME=pod1;CNI_TEST_NAMESPACE=test", "k8s", "ns1", "pod1"),
+		table.Entry("k8s needs both pod name and namespace", "K8S_POD_NAMESPACE=ns1", "cni", "default", ""),
+		table.Entry("cni", "", "cni", "default", ""),
+		table.Entry("cni with test namespace", "CNI_TEST_NAMESPACE=test", "cni", "test", ""),
+	)
+
+	Describe("CreateProfile", func() {
+		var profiles *fakeProfiles
+		var profile *api.Profile
+
+		BeforeEach(func() {
+			profiles = &fakeProfiles{}
+			profile = api.NewProfile()
+			profile.Name = "net1"
+		})
+
+		It("should create the profile", func() {
+			err := utils.CreateProfile(context.Background(), fakeClient{profiles: profiles}, profile)
+			Expect(err).NotTo(HaveOccurred())
+			Expect(profiles.creates).To(Equal(1))
+		})
+
+		It("should treat a concurrently created profile as success", func() {
+			profiles.createErr = cerrors.ErrorResourceAlreadyExists{Identifier: "net1"}
+			err := utils.CreateProfile(context.Background(), fakeClient{profiles: profiles}, profile)
+			Expect(err).NotTo(HaveOccurred())
+			Expect(profiles.creates).To(Equal(1))
+		})
+
+		It("should return other errors", func() {
+			profiles.createErr = errors.New("datastore unavailable")
+			err := utils.CreateProfile(context.Background(), fakeClient{profiles: profiles}, profile)
+			Expect(err).To(Equal(profiles.createErr))
+		})
+	})
+
+	Describe("ResolvePools", func() {
+		var ipPools *fakeIPPools
+
+		BeforeEach(func() {
+			pool1 := api.NewIPPool()
+			pool1.Name = "pool1"
+			pool1.Spec.CIDR = "10.1.0.0/16"
+			pool2 := api.NewIPPool()
+			pool2.Name = "pool2"
+			pool2.Spec.CIDR = "10.2.0.0/16"
+			ipPools = &fakeIPPools{items: []api.IPPool{*pool1, *pool2}}
+		})
+
+		It("should not list IP pools when given only CIDRs", func() {
+			result, err := utils.ResolvePools(context.Background(), fakeClient{ipPools: ipPools}, []string{"10.3.0.0/16", "10.4.0.0/16"}, true)
+			Expect(err).NotTo(HaveOccurred())
+			Expect(result).To(HaveLen(2))
+			Expect(result[0].String()).To(Equal("10.3.0.0/16"))
+			Expect(result[1].String()).To(Equal("10.4.0.0/16"))
+			Expect(ipPools.lists).To(Equal(0))
+		})
+
+		It("should list IP pools once to resolve names", func() {
+			result, err := utils.ResolvePools(context.Background(), fakeClient{ipPools: ipPools}, []string{"pool1", "10.3.0.0/16", "pool2"}, true)
+			Expect(err).NotTo(HaveOccurred())
+			Expect(result).To(HaveLen(3))
+			Expect(result[0].String()).To(Equal("10.1.0.0/16"))
+			Expect(result[1].String()).To(Equal("10.3.0.0/16"))
+			Expect(result[2].String()).To(Equal("10.2.0.0/16"))
+			Expect(ipPools.lists).To(Equal(1))
+		})
+
+		It("should fail to resolve an unknown pool name", func() {
+			_, err := utils.ResolvePools(context.Background(), fakeClient{ipPools: ipPools}, []string{"pool3"}, true)
+			Expect(err).To(HaveOccurred())
+		})
+	})
+
+	It("should reject unknown CNI args unless told to ignore them", func() {
+		args := &skel.CmdArgs{ContainerID: "abc123", IfName: "eth0", Args: "FOO=bar"}
+		_, err := utils.GetIdentifiers(args, "node1")
+		Expect(err).To(HaveOccurred())
+
+		args.Args = "IgnoreUnknown=1;FOO=bar"
+		epIDs, err := utils.GetIdentifiers(args, "node1")
+		Expect(err).NotTo(HaveOccurred())
+		Expect(epIDs.Orchestrator).To(Equal("cni"))
+	})
 })
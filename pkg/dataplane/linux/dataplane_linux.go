@@ -464,18 +464,28 @@ func (d *linuxDataplane) CleanUpNamespace(args *skel.CmdArgs) error {
 			"netns": args.Netns,
 			"iface": args.IfName,
 		}).Debug("Checking namespace & device exist.")
-		devErr := ns.WithNetNSPath(args.Netns, func(_ ns.NetNS) error {
-			_, err := netlink.LinkByName(args.IfName)
-			return err
-		})
+		// Open the namespace once for both the check and the delete below.
+		netNS, devErr := ns.GetNS(args.Netns)
+		if devErr == nil {
+			devErr = netNS.Do(func(_ ns.NetNS) error {
+				_, err := netlink.LinkByName(args.IfName)
+				return err
+			})
+			if devErr != nil {
+				netNS.Close()
+			}
+		}
 
 		if devErr == nil {
 			d.logger.Infof("Calico CNI deleting device in netns %s", args.Netns)
 			// Deleting the veth has been seen to hang on some kernel version. Timeout the command if it takes too long.
 			ch := make(chan error, 1)
 
+			// The goroutine owns the namespace handle from here on, since it may still be using it after
+			// we've timed out and returned.
 			go func() {
-				err := ns.WithNetNSPath(args.Netns, func(_ ns.NetNS) error {
+				defer netNS.Close()
+				err := netNS.Do(func(_ ns.NetNS) error {
 					return ip.DelLinkByName(args.IfName)
 				})
 
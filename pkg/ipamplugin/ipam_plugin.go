@@ -126,19 +126,48 @@ func cmdAdd(args *skel.CmdArgs) error {
 
 	utils.ConfigureLogging(conf)
 
-	calicoClient, err := utils.CreateClient(conf)
+	r, err := assignIPs(args, conf, nodename)
 	if err != nil {
 		return err
 	}
 
+	// Print result to stdout, in the format defined by the requested cniVersion.
+	return cnitypes.PrintResult(r, conf.CNIVersion)
+}
+
+// CmdAddInProcess performs the calico-ipam ADD within the calling process and returns the result
+// directly instead of printing it. It allows the Calico CNI plugin, which is built into the same binary,
+// to allocate addresses without executing calico-ipam and parsing its output.
+func CmdAddInProcess(args *skel.CmdArgs) (*current.Result, error) {
+	conf := types.NetConf{}
+	if err := json.Unmarshal(args.StdinData, &conf); err != nil {
+		return nil, fmt.Errorf("failed to load netconf: %v", err)
+	}
+	r, err := assignIPs(args, conf, utils.DetermineNodename(conf))
+	if err != nil {
+		return nil, err
+	}
+
+	// The executed plugin sets the version when printing its result; set it here instead so that callers
+	// don't mistake the result for a legacy one.
+	r.CNIVersion = current.ImplementedSpecVersion
+	return r, nil
+}
+
+func assignIPs(args *skel.CmdArgs, conf types.NetConf, nodename string) (*current.Result, error) {
+	calicoClient, err := utils.CreateClient(conf)
+	if err != nil {
+		return nil, err
+	}
+
 	epIDs, err := utils.GetIdentifiers(args, nodename)
 	if err != nil {
-		return err
+		return nil, err
 	}
 
 	epIDs.WEPName, err = epIDs.CalculateWorkloadEndpointName(false)
 	if err != nil {
-		return fmt.Errorf("error constructing WorkloadEndpoint name: %s", err)
+		return nil, fmt.Errorf("error constructing WorkloadEndpoint name: %s", err)
 	}
 
 	handleID := utils.GetHandleID(conf.Name, args.ContainerID, epIDs.WEPName)
@@ -151,7 +180,7 @@ func cmdAdd(args *skel.CmdArgs) error {
 
 	ipamArgs := ipamArgs{}
 	if err = cnitypes.LoadArgs(args.Args, &ipamArgs); err != nil {
-		return err
+		return nil, err
 	}
 
 	// We attach important attributes to the allocation.
@@ -186,7 +215,7 @@ func cmdAdd(args *skel.CmdArgs) error {
 		}
 		err := assignIPWithLock()
 		if err != nil {
-			return err
+			return nil, err
 		}
 
 		var ipNetwork net.IPNet
@@ -227,12 +256,12 @@ func cmdAdd(args *skel.CmdArgs) error {
 
 		v4pools, err := utils.ResolvePools(ctx, calicoClient, conf.IPAM.IPv4Pools, true)
 		if err != nil {
-			return err
+			return nil, err
 		}
 
 		v6pools, err := utils.ResolvePools(ctx, calicoClient, conf.IPAM.IPv6Pools, false)
 		if err != nil {
-			return err
+			return nil, err
 		}
 
 		logger.Debugf("Calico CNI IPAM handle=%s", handleID)
@@ -275,7 +304,7 @@ func cmdAdd(args *skel.CmdArgs) error {
 		assignedV4, assignedV6, err := autoAssignWithLock(calicoClient, ctx, assignArgs)
 		logger.Infof("Calico CNI IPAM assigned addresses IPv4=%v IPv6=%v", assignedV4, assignedV6)
 		if err != nil {
-			return err
+			return nil, err
 		}
 
 		// Check if IPv4 address assignment fails but IPv6 address assignment succeeds. Release IPs for the successful IPv6 address assignment.
@@ -285,7 +314,7 @@ func cmdAdd(args *skel.CmdArgs) error {
 				// Free the assigned IPv6 addresses when v4 address assignment fails.
 				v6IPs := []cnet.IP{}
 				for _, v6 := range assignedV6 {
-					v6IPs = append(v6IPs, *cnet.ParseIP(v6.IP.String()))
+					v6IPs = append(v6IPs, cnet.IP{IP: v6.IP})
 				}
 				_, err := calicoClient.IPAM().ReleaseIPs(ctx, v6IPs)
 				if err != nil {
@@ -301,7 +330,7 @@ func cmdAdd(args *skel.CmdArgs) error {
 				// Free the assigned IPv4 addresses when v4 address assignment fails.
 				v4IPs := []cnet.IP{}
 				for _, v4 := range assignedV4 {
-					v4IPs = append(v4IPs, *cnet.ParseIP(v4.IP.String()))
+					v4IPs = append(v4IPs, cnet.IP{IP: v4.IP})
 				}
 				_, err := calicoClient.IPAM().ReleaseIPs(ctx, v4IPs)
 				if err != nil {
@@ -312,7 +341,7 @@ func cmdAdd(args *skel.CmdArgs) error {
 
 		if num4 == 1 {
 			if len(assignedV4) != num4 {
-				return fmt.Errorf("failed to request %d IPv4 addresses. IPAM allocated only %d", num4, len(assignedV4))
+				return nil, fmt.Errorf("failed to request %d IPv4 addresses. IPAM allocated only %d", num4, len(assignedV4))
 			}
 			ipV4Network := net.IPNet{IP: assignedV4[0].IP, Mask: assignedV4[0].Mask}
 			r.IPs = append(r.IPs, &current.IPConfig{
@@ -323,7 +352,7 @@ func cmdAdd(args *skel.CmdArgs) error {
 
 		if num6 == 1 {
 			if len(assignedV6) != num6 {
-				return fmt.Errorf("failed to request %d IPv6 addresses. IPAM allocated only %d", num6, len(assignedV6))
+				return nil, fmt.Errorf("failed to request %d IPv6 addresses. IPAM allocated only %d", num6, len(assignedV6))
 			}
 			ipV6Network := net.IPNet{IP: assignedV6[0].IP, Mask: assignedV6[0].Mask}
 			r.IPs = append(r.IPs, &current.IPConfig{
@@ -335,8 +364,7 @@ func cmdAdd(args *skel.CmdArgs) error {
 		logger.WithFields(logrus.Fields{"result.IPs": r.IPs}).Debug("IPAM Result")
 	}
 
-	// Print result to stdout, in the format defined by the requested cniVersion.
-	return cnitypes.PrintResult(r, conf.CNIVersion)
+	return r, nil
 }
 
 type unlockFn func()
@@ -364,7 +392,7 @@ func acquireIPAMLockBestEffort(path string) unlockFn {
 	return func() {
 		err := ipamLock.Unlock()
 		if err != nil {
-			logrus.WithError(err).Warn("Failed to release IPAM lock; ignoring because process is about to exit.")
+			logrus.WithError(err).Warn("Failed to release IPAM lock; it will be released when the process exits.")
 		} else {
 			log.Info("Released host-wide IPAM lock.")
 		}
@@ -379,6 +407,20 @@ func cmdDel(args *skel.CmdArgs) error {
 
 	utils.ConfigureLogging(conf)
 
+	return releaseIPs(args, conf)
+}
+
+// CmdDelInProcess performs the calico-ipam DEL within the calling process, in the same way that
+// CmdAddInProcess performs the ADD.
+func CmdDelInProcess(args *skel.CmdArgs) error {
+	conf := types.NetConf{}
+	if err := json.Unmarshal(args.StdinData, &conf); err != nil {
+		return fmt.Errorf("failed to load netconf: %v", err)
+	}
+	return releaseIPs(args, conf)
+}
+
+func releaseIPs(args *skel.CmdArgs, conf types.NetConf) error {
 	calicoClient, err := utils.CreateClient(conf)
 	if err != nil {
 		return err
@@ -429,7 +471,7 @@ func cmdDel(args *skel.CmdArgs) error {
 	// Calculate the workloadID to account for v2.x upgrades.
 	workloadID := epIDs.ContainerID
 	if epIDs.Orchestrator == "k8s" {
-		workloadID = fmt.Sprintf("%s.%s", epIDs.Namespace, epIDs.Pod)
+		workloadID = epIDs.Namespace + "." + epIDs.Pod
 	}
 
 	logger.Info("Releasing address using workloadID")
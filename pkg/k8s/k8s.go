@@ -27,7 +27,6 @@ import (
 	"github.com/containernetworking/cni/pkg/skel"
 	cnitypes "github.com/containernetworking/cni/pkg/types"
 	"github.com/containernetworking/cni/pkg/types/current"
-	"github.com/containernetworking/plugins/pkg/ipam"
 
 	"github.com/sirupsen/logrus"
 	metav1 "k8s.io/apimachinery/pkg/apis/meta/v1"
@@ -50,11 +49,12 @@ import (
 // CmdAddK8s performs the "ADD" operation on a kubernetes pod
 // Having kubernetes code in its own file avoids polluting the mainline code. It's expected that the kubernetes case will
 // more special casing than the mainline code.
-func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epIDs utils.WEPIdentifiers, calicoClient calicoclient.Interface, endpoint *api.WorkloadEndpoint) (*current.Result, error) {
+func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epIDs utils.WEPIdentifiers, calicoClient calicoclient.Interface, endpoint *api.WorkloadEndpoint) (*current.Result, bool, error) {
 	var err error
 	var result *current.Result
 
-	utils.ConfigureLogging(conf)
+	// Track whether IP addresses were allocated by IPAM for this call, rather than reused or assigned without IPAM.
+	ipAllocated := false
 
 	logger := logrus.WithFields(logrus.Fields{
 		"WorkloadEndpoint": epIDs.WEPName,
@@ -65,23 +65,32 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 
 	d, err := dataplane.GetDataplane(conf, logger)
 	if err != nil {
-		return nil, err
+		return nil, false, err
 	}
 
 	logger.Info("Extracted identifiers for CmdAddK8s")
 
 	result, err = utils.CheckForSpuriousDockerAdd(args, conf, epIDs, endpoint, logger)
 	if result != nil || err != nil {
-		return result, err
+		return result, false, err
 	}
 
 	// Allocate the IP and update/create the endpoint. Do this even if the endpoint already exists and has an IP
 	// allocation. The kubelet will send a DEL call for any old containers and we'll clean up the old IPs then.
-	client, err := NewK8sClient(conf, logger)
-	if err != nil {
-		return nil, err
+	// The Kubernetes client is only needed to look up the pod CIDR or the pod's labels and annotations, so
+	// we create it lazily to avoid loading the kubeconfig when neither is required.
+	var k8sClient *kubernetes.Clientset
+	getK8sClient := func() (*kubernetes.Clientset, error) {
+		if k8sClient == nil {
+			c, err := NewK8sClient(conf, logger)
+			if err != nil {
+				return nil, err
+			}
+			logger.WithField("client", c).Debug("Created Kubernetes client")
+			k8sClient = c
+		}
+		return k8sClient, nil
 	}
-	logger.WithField("client", client).Debug("Created Kubernetes client")
 
 	var routes []*net.IPNet
 	if conf.IPAM.Type == "host-local" {
@@ -101,14 +110,17 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		// round-trip any fields that we don't know about.
 		var stdinData map[string]interface{}
 		if err := json.Unmarshal(args.StdinData, &stdinData); err != nil {
-			return nil, err
+			return nil, false, err
 		}
 
 		// Defer to ReplaceHostLocalIPAMPodCIDRs to swap the "usePodCidr" value out.
 		var cachedPodCidr string
 		getRealPodCIDR := func() (string, error) {
 			if cachedPodCidr == "" {
-				var err error
+				client, err := getK8sClient()
+				if err != nil {
+					return "", err
+				}
 				cachedPodCidr, err = getPodCidr(client, conf, epIDs.Node)
 				if err != nil {
 					return "", err
@@ -118,13 +130,13 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		}
 		err = utils.ReplaceHostLocalIPAMPodCIDRs(logger, stdinData, getRealPodCIDR)
 		if err != nil {
-			return nil, err
+			return nil, false, err
 		}
 
 		// Write any changes we made back to the input data so that it'll be passed on to the IPAM plugin.
 		args.StdinData, err = json.Marshal(stdinData)
 		if err != nil {
-			return nil, err
+			return nil, false, err
 		}
 		logger.Debug("Updated stdin data")
 
@@ -133,11 +145,15 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		untypedRoutes := ipamData["routes"]
 		hlRoutes, ok := untypedRoutes.([]interface{})
 		if untypedRoutes != nil && !ok {
-			return nil, fmt.Errorf(
+			return nil, false, fmt.Errorf(
 				"failed to parse host-local IPAM routes section; expecting list, not: %v", stdinData["ipam"])
 		}
-		for _, route := range hlRoutes {
-			route := route.(map[string]interface{})
+		for _, untypedRoute := range hlRoutes {
+			route, ok := untypedRoute.(map[string]interface{})
+			if !ok {
+				return nil, false, fmt.Errorf(
+					"invalid IPAM routes section; expecting each route to be a dict, not: %v", untypedRoute)
+			}
 			untypedDst, ok := route["dst"]
 			if !ok {
 				logger.Debug("Ignoring host-ipam route with no dst")
@@ -145,14 +161,14 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 			}
 			dst, ok := untypedDst.(string)
 			if !ok {
-				return nil, fmt.Errorf(
+				return nil, false, fmt.Errorf(
 					"invalid IPAM routes section; expecting 'dst' to be a string, not: %v", untypedDst)
 			}
 			_, cidr, err := net.ParseCIDR(dst)
 			if err != nil {
 				logger.WithError(err).WithField("routeDest", dst).Error(
 					"Failed to parse destination of host-local IPAM route in CNI configuration.")
-				return nil, err
+				return nil, false, err
 			}
 			routes = append(routes, cidr)
 		}
@@ -184,15 +200,20 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 	// run the plugin under Kubernetes without needing it to access the
 	// Kubernetes API
 	if conf.Policy.PolicyType == "k8s" {
+		client, err := getK8sClient()
+		if err != nil {
+			return nil, false, err
+		}
+
 		annotNS, err := getK8sNSInfo(client, epIDs.Namespace)
 		if err != nil {
-			return nil, err
+			return nil, false, err
 		}
 		logger.WithField("NS Annotations", annotNS).Debug("Fetched K8s namespace annotations")
 
 		labels, annot, ports, profiles, generateName, err = getK8sPodInfo(client, epIDs.Pod, epIDs.Namespace)
 		if err != nil {
-			return nil, err
+			return nil, false, err
 		}
 		logger.WithField("labels", labels).Debug("Fetched K8s labels")
 		logger.WithField("annotations", annot).Debug("Fetched K8s annotations")
@@ -221,18 +242,18 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 			if len(v4pools) != 0 || len(v6pools) != 0 {
 				var stdinData map[string]interface{}
 				if err := json.Unmarshal(args.StdinData, &stdinData); err != nil {
-					return nil, err
+					return nil, false, err
 				}
 				var v4PoolSlice, v6PoolSlice []string
 
 				if len(v4pools) > 0 {
 					if err := json.Unmarshal([]byte(v4pools), &v4PoolSlice); err != nil {
 						logger.WithField("IPv4Pool", v4pools).Error("Error parsing IPv4 IPPools")
-						return nil, err
+						return nil, false, err
 					}
 
 					if _, ok := stdinData["ipam"].(map[string]interface{}); !ok {
-						return nil, errors.New("data on stdin was of unexpected type")
+						return nil, false, errors.New("data on stdin was of unexpected type")
 					}
 					stdinData["ipam"].(map[string]interface{})["ipv4_pools"] = v4PoolSlice
 					logger.WithField("ipv4_pools", v4pools).Debug("Setting IPv4 Pools")
@@ -240,11 +261,11 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 				if len(v6pools) > 0 {
 					if err := json.Unmarshal([]byte(v6pools), &v6PoolSlice); err != nil {
 						logger.WithField("IPv6Pool", v6pools).Error("Error parsing IPv6 IPPools")
-						return nil, err
+						return nil, false, err
 					}
 
 					if _, ok := stdinData["ipam"].(map[string]interface{}); !ok {
-						return nil, errors.New("data on stdin was of unexpected type")
+						return nil, false, errors.New("data on stdin was of unexpected type")
 					}
 					stdinData["ipam"].(map[string]interface{})["ipv6_pools"] = v6PoolSlice
 					logger.WithField("ipv6_pools", v6pools).Debug("Setting IPv6 Pools")
@@ -253,7 +274,7 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 				newData, err := json.Marshal(stdinData)
 				if err != nil {
 					logger.WithField("stdinData", stdinData).Error("Error Marshaling data")
-					return nil, err
+					return nil, false, err
 				}
 				args.StdinData = newData
 				logger.Debug("Updated stdin data")
@@ -270,32 +291,33 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		// Call the IPAM plugin.
 		result, err = utils.AddIPAM(conf, args, logger)
 		if err != nil {
-			return nil, err
+			return nil, false, err
 		}
+		ipAllocated = true
 
 	case ipAddrs != "" && ipAddrsNoIpam != "":
 		// Can't have both ipAddrs and ipAddrsNoIpam annotations at the same time.
 		e := fmt.Errorf("can't have both annotations: 'ipAddrs' and 'ipAddrsNoIpam' in use at the same time")
 		logger.Error(e)
-		return nil, e
+		return nil, false, e
 
 	case ipAddrsNoIpam != "":
 		// Validate that we're allowed to use this feature.
 		if conf.IPAM.Type != "calico-ipam" {
 			e := fmt.Errorf("ipAddrsNoIpam is not compatible with configured IPAM: %s", conf.IPAM.Type)
 			logger.Error(e)
-			return nil, e
+			return nil, false, e
 		}
 		if !conf.FeatureControl.IPAddrsNoIpam {
 			e := fmt.Errorf("requested feature is not enabled: ip_addrs_no_ipam")
 			logger.Error(e)
-			return nil, e
+			return nil, false, e
 		}
 
 		// ipAddrsNoIpam annotation is set so bypass IPAM, and set the IPs manually.
 		overriddenResult, err := overrideIPAMResult(ipAddrsNoIpam, logger)
 		if err != nil {
-			return nil, err
+			return nil, false, err
 		}
 		logger.Debugf("Bypassing IPAM to set the result to: %+v", overriddenResult)
 
@@ -303,11 +325,11 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		// This method fill in all the empty fields necessory for CNI output according to spec.
 		result, err = current.NewResultFromResult(overriddenResult)
 		if err != nil {
-			return nil, err
+			return nil, false, err
 		}
 
 		if len(result.IPs) == 0 {
-			return nil, errors.New("failed to build result")
+			return nil, false, errors.New("failed to build result")
 		}
 
 	case ipAddrs != "":
@@ -315,7 +337,7 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		if conf.IPAM.Type != "calico-ipam" {
 			e := fmt.Errorf("ipAddrs is not compatible with configured IPAM: %s", conf.IPAM.Type)
 			logger.Error(e)
-			return nil, e
+			return nil, false, e
 		}
 
 		// If the endpoint already exists, we need to attempt to release the previous IP addresses here
@@ -325,7 +347,7 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		if endpoint != nil {
 			logger.Info("Endpoint already exists and ipAddrs is set. Release any old IPs")
 			if err := releaseIPAddrs(endpoint.Spec.IPNetworks, calicoClient, logger); err != nil {
-				return nil, fmt.Errorf("failed to release ipAddrs: %s", err)
+				return nil, false, fmt.Errorf("failed to release ipAddrs: %s", err)
 			}
 		}
 
@@ -333,8 +355,9 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		// requesting the specific IP addresses included in the annotation.
 		result, err = ipAddrsResult(ipAddrs, conf, args, logger)
 		if err != nil {
-			return nil, err
+			return nil, false, err
 		}
+		ipAllocated = true
 		logger.Debugf("IPAM result set to: %+v", result)
 	}
 
@@ -366,14 +389,20 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 	// Populate the endpoint with the output from the IPAM plugin.
 	if err = utils.PopulateEndpointNets(endpoint, result); err != nil {
 		// Cleanup IP allocation and return the error.
-		utils.ReleaseIPAllocation(logger, conf, args)
-		return nil, err
+		if ipAllocated {
+			utils.ReleaseIPAllocation(logger, conf, args)
+		}
+		return nil, false, err
 	}
 	logger.WithField("endpoint", endpoint).Info("Populated endpoint")
 	logger.Infof("Calico CNI using IPs: %s", endpoint.Spec.IPNetworks)
 
-	// releaseIPAM cleans up any IPAM allocations on failure.
+	// releaseIPAM cleans up any IPAM allocations on failure. Addresses assigned without IPAM, from the
+	// ipAddrsNoIpam annotation, were never allocated, so there is nothing to release for them.
 	releaseIPAM := func() {
+		if !ipAllocated {
+			return
+		}
 		logger.WithField("endpointIPs", endpoint.Spec.IPNetworks).Info("Releasing IPAM allocation(s) after failure")
 		utils.ReleaseIPAllocation(logger, conf, args)
 	}
@@ -385,14 +414,14 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 	if err != nil {
 		logger.WithError(err).Error("Error setting up networking")
 		releaseIPAM()
-		return nil, err
+		return nil, false, err
 	}
 
 	mac, err := net.ParseMAC(contVethMac)
 	if err != nil {
 		logger.WithError(err).WithField("mac", mac).Error("Error parsing container MAC")
 		releaseIPAM()
-		return nil, err
+		return nil, false, err
 	}
 	endpoint.Spec.MAC = mac.String()
 	endpoint.Spec.InterfaceName = hostVethName
@@ -400,7 +429,9 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 	logger.WithField("endpoint", endpoint).Info("Added Mac, interface name, and active container ID to endpoint")
 
 	if conf.Mode == "vxlan" {
-		_, subNet, _ := net.ParseCIDR(result.IPs[0].Address.String())
+		// Take the subnet of the first IP directly rather than formatting and reparsing its CIDR.
+		addr := result.IPs[0].Address
+		subNet := &net.IPNet{IP: addr.IP.Mask(addr.Mask), Mask: addr.Mask}
 		var err error
 		for attempts := 3; attempts > 0; attempts-- {
 			err = utils.EnsureVXLANTunnelAddr(ctx, calicoClient, epIDs.Node, subNet, conf)
@@ -423,12 +454,12 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		// If floating IPs are defined, but the feature is not enabled, return an error.
 		if !conf.FeatureControl.FloatingIPs {
 			releaseIPAM()
-			return nil, fmt.Errorf("requested feature is not enabled: floating_ips")
+			return nil, false, fmt.Errorf("requested feature is not enabled: floating_ips")
 		}
 		ips, err := parseIPAddrs(floatingIPs, logger)
 		if err != nil {
 			releaseIPAM()
-			return nil, err
+			return nil, false, err
 		}
 
 		// Get IPv4 and IPv6 targets for NAT
@@ -438,13 +469,15 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 				podnetV4 = ipNet.Address
 				netmask, _ := podnetV4.Mask.Size()
 				if netmask != 32 {
-					return nil, fmt.Errorf("PodIP %v is not a valid IPv4: Mask size is %d, not 32", ipNet, netmask)
+					releaseIPAM()
+					return nil, false, fmt.Errorf("PodIP %v is not a valid IPv4: Mask size is %d, not 32", ipNet, netmask)
 				}
 			} else {
 				podnetV6 = ipNet.Address
 				netmask, _ := podnetV6.Mask.Size()
 				if netmask != 128 {
-					return nil, fmt.Errorf("PodIP %v is not a valid IPv6: Mask size is %d, not 128", ipNet, netmask)
+					releaseIPAM()
+					return nil, false, fmt.Errorf("PodIP %v is not a valid IPv6: Mask size is %d, not 128", ipNet, netmask)
 				}
 			}
 		}
@@ -469,7 +502,7 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 	if _, err := utils.CreateOrUpdate(ctx, calicoClient, endpoint); err != nil {
 		logger.WithError(err).Error("Error creating/updating endpoint in datastore.")
 		releaseIPAM()
-		return nil, err
+		return nil, false, err
 	}
 	logger.Info("Wrote updated endpoint to datastore")
 
@@ -478,7 +511,7 @@ func CmdAddK8s(ctx context.Context, args *skel.CmdArgs, conf types.NetConf, epID
 		Name: endpoint.Spec.InterfaceName},
 	)
 
-	return result, nil
+	return result, ipAllocated, nil
 }
 
 // CmdDelK8s performs CNI DEL processing when running under Kubernetes. In Kubernetes, we identify workload endpoints based on their
@@ -578,24 +611,30 @@ func CmdDelK8s(ctx context.Context, c calicoclient.Interface, epIDs utils.WEPIde
 // releaseIPAddrs calls directly into Calico IPAM to release the specified IP addresses.
 // NOTE: This function assumes Calico IPAM is in use, and calls into it directly rather than calling the IPAM plugin.
 func releaseIPAddrs(ipAddrs []string, calico calicoclient.Interface, logger *logrus.Entry) error {
-	// For each IP, call out to Calico IPAM to release it.
+	// Parse all of the IPs up front so that they can be released with a single call to Calico IPAM.
+	ips := make([]cnet.IP, 0, len(ipAddrs))
 	for _, ip := range ipAddrs {
-		log := logger.WithField("IP", ip)
-		log.Info("Releasing explicitly requested address")
 		cip, _, err := cnet.ParseCIDR(ip)
 		if err != nil {
 			return err
 		}
-		unallocated, err := calico.IPAM().ReleaseIPs(context.Background(), []cnet.IP{*cip})
-		if err != nil {
-			log.WithError(err).Error("Failed to release explicit IP")
-			return err
-		}
-		if len(unallocated) > 0 {
-			log.Warn("Asked to release address but it doesn't exist.")
-		} else {
-			log.Infof("Released explicit address: %s", ip)
-		}
+		ips = append(ips, *cip)
+	}
+	if len(ips) == 0 {
+		return nil
+	}
+
+	log := logger.WithField("IPs", ipAddrs)
+	log.Info("Releasing explicitly requested addresses")
+	unallocated, err := calico.IPAM().ReleaseIPs(context.Background(), ips)
+	if err != nil {
+		log.WithError(err).Error("Failed to release explicit IPs")
+		return err
+	}
+	if len(unallocated) > 0 {
+		log.WithField("unallocated", unallocated).Warn("Asked to release addresses but they don't exist.")
+	} else {
+		log.Info("Released explicit addresses")
 	}
 	return nil
 }
@@ -613,6 +652,20 @@ func ipAddrsResult(ipAddrs string, conf types.NetConf, args *skel.CmdArgs, logge
 		return nil, err
 	}
 
+	// Check the CNI_ARGS once up front, rather than for each IP we request.
+	ipamArgs := struct {
+		cnitypes.CommonArgs
+		IP net.IP `json:"ip,omitempty"`
+	}{}
+
+	if err := cnitypes.LoadArgs(args.Args, &ipamArgs); err != nil {
+		return nil, err
+	}
+
+	if ipamArgs.IP != nil {
+		logger.Errorf("'IP' variable already set in CNI_ARGS environment variable.")
+	}
+
 	result := current.Result{}
 
 	// Go through all the IPs passed in as annotation value and call IPAM plugin
@@ -641,19 +694,6 @@ func callIPAMWithIP(ip net.IP, conf types.NetConf, args *skel.CmdArgs, logger *l
 	originalArgs := os.Getenv("CNI_ARGS")
 	logger.Debugf("Original CNI_ARGS=%s", originalArgs)
 
-	ipamArgs := struct {
-		cnitypes.CommonArgs
-		IP net.IP `json:"ip,omitempty"`
-	}{}
-
-	if err := cnitypes.LoadArgs(args.Args, &ipamArgs); err != nil {
-		return nil, err
-	}
-
-	if ipamArgs.IP != nil {
-		logger.Errorf("'IP' variable already set in CNI_ARGS environment variable.")
-	}
-
 	// Request the provided IP address using the IP CNI_ARG.
 	// See: https://github.com/containernetworking/cni/blob/master/CONVENTIONS.md#cni_args for more info.
 	newArgs := originalArgs + ";IP=" + ip.String()
@@ -665,9 +705,12 @@ func callIPAMWithIP(ip net.IP, conf types.NetConf, args *skel.CmdArgs, logger *l
 		return nil, fmt.Errorf("error setting CNI_ARGS environment variable: %v", err)
 	}
 
-	// Run the IPAM plugin.
+	// Run the IPAM plugin. The requested IP is passed in the CNI args as well as the environment, so that
+	// it also reaches calico-ipam when that is called in-process.
+	ipamCmdArgs := *args
+	ipamCmdArgs.Args = newArgs
 	logger.Debugf("Calling IPAM plugin %s", conf.IPAM.Type)
-	r, err := ipam.ExecAdd(conf.IPAM.Type, args.StdinData)
+	r, err := utils.ExecAddIPAM(conf, &ipamCmdArgs)
 	if err != nil {
 		// Restore the CNI_ARGS ENV var to it's original value,
 		// so the subsequent calls don't get polluted by the old IP value.
@@ -19,7 +19,6 @@ import (
 	"errors"
 	"flag"
 	"fmt"
-	"io/ioutil"
 	"os"
 	"runtime"
 	"time"
@@ -28,7 +27,6 @@ import (
 	cnitypes "github.com/containernetworking/cni/pkg/types"
 	"github.com/containernetworking/cni/pkg/types/current"
 	cniSpecVersion "github.com/containernetworking/cni/pkg/version"
-	"github.com/containernetworking/plugins/pkg/ipam"
 	"github.com/sirupsen/logrus"
 	metav1 "k8s.io/apimachinery/pkg/apis/meta/v1"
 	"k8s.io/client-go/kubernetes"
@@ -36,6 +34,7 @@ import (
 
 	"github.com/projectcalico/cni-plugin/internal/pkg/utils"
 	"github.com/projectcalico/cni-plugin/pkg/dataplane"
+	"github.com/projectcalico/cni-plugin/pkg/ipamplugin"
 	"github.com/projectcalico/cni-plugin/pkg/k8s"
 	"github.com/projectcalico/cni-plugin/pkg/types"
 	api "github.com/projectcalico/libcalico-go/lib/apis/v3"
@@ -55,13 +54,9 @@ func init() {
 }
 
 func testConnection() error {
-	// Unmarshal the network config
+	// Decode the network config directly from stdin.
 	conf := types.NetConf{}
-	data, err := ioutil.ReadAll(os.Stdin)
-	if err != nil {
-		return errors.New("failed to read from stdin")
-	}
-	if err := json.Unmarshal(data, &conf); err != nil {
+	if err := json.NewDecoder(os.Stdin).Decode(&conf); err != nil {
 		return fmt.Errorf("failed to load netconf: %v", err)
 	}
 
@@ -113,7 +108,7 @@ func cmdAdd(args *skel.CmdArgs) (err error) {
 				// present both.
 				msg = fmt.Sprintf("%s: error=%s", msg, err)
 			}
-			err = fmt.Errorf(msg)
+			err = errors.New(msg)
 		}
 		if err != nil {
 			logrus.WithError(err).Error("Final result of CNI ADD was an error.")
@@ -278,10 +273,14 @@ func cmdAdd(args *skel.CmdArgs) (err error) {
 	// it to stdout.
 	var result *current.Result
 
+	// Track whether this invocation allocated IP addresses. Failures after this point only release
+	// the allocation if we made it, so that we never release addresses belonging to an existing endpoint.
+	ipAllocated := false
+
 	// If running under Kubernetes then branch off into the kubernetes code, otherwise handle everything in this
 	// function.
 	if wepIDs.Orchestrator == api.OrchestratorKubernetes {
-		if result, err = k8s.CmdAddK8s(ctx, args, conf, *wepIDs, calicoClient, endpoint); err != nil {
+		if result, ipAllocated, err = k8s.CmdAddK8s(ctx, args, conf, *wepIDs, calicoClient, endpoint); err != nil {
 			return
 		}
 	} else {
@@ -330,11 +329,12 @@ func cmdAdd(args *skel.CmdArgs) (err error) {
 			logger.WithFields(logrus.Fields{"paths": os.Getenv("CNI_PATH"),
 				"type": conf.IPAM.Type}).Debug("Looking for IPAM plugin in paths")
 			var ipamResult cnitypes.Result
-			ipamResult, err = ipam.ExecAdd(conf.IPAM.Type, args.StdinData)
+			ipamResult, err = utils.ExecAddIPAM(conf, args)
 			logger.WithField("IPAM result", ipamResult).Info("Got result from IPAM plugin")
 			if err != nil {
 				return
 			}
+			ipAllocated = true
 
 			// Convert IPAM result into current Result.
 			// IPAM result has a bunch of fields that are optional for an IPAM plugin
@@ -417,9 +417,9 @@ func cmdAdd(args *skel.CmdArgs) (err error) {
 
 		// Write the endpoint object (either the newly created one, or the updated one with a new ProfileIDs).
 		if _, err = utils.CreateOrUpdate(ctx, calicoClient, endpoint); err != nil {
-			if !endpointAlreadyExisted {
-				// Only clean up the IP allocation if this was a new endpoint.  Otherwise,
-				// we'd release the IP that is already attached to the existing endpoint.
+			if ipAllocated {
+				// Only clean up the IP allocation if this invocation allocated it through IPAM.  Otherwise,
+				// we'd release an IP that is attached to an existing endpoint or was never allocated.
 				utils.ReleaseIPAllocation(logger, conf, args)
 			}
 			return
@@ -446,7 +446,9 @@ func cmdAdd(args *skel.CmdArgs) (err error) {
 				exists = false
 			} else {
 				// Cleanup IP allocation and return the error.
-				utils.ReleaseIPAllocation(logger, conf, args)
+				if ipAllocated {
+					utils.ReleaseIPAllocation(logger, conf, args)
+				}
 				return
 			}
 		}
@@ -476,9 +478,11 @@ func cmdAdd(args *skel.CmdArgs) (err error) {
 
 			logger.WithField("profile", profile).Info("Creating profile")
 
-			if _, err = calicoClient.Profiles().Create(ctx, profile, options.SetOptions{}); err != nil {
+			if err = utils.CreateProfile(ctx, calicoClient, profile); err != nil {
 				// Cleanup IP allocation and return the error.
-				utils.ReleaseIPAllocation(logger, conf, args)
+				if ipAllocated {
+					utils.ReleaseIPAllocation(logger, conf, args)
+				}
 				return
 			}
 		}
@@ -507,7 +511,7 @@ func cmdDel(args *skel.CmdArgs) (err error) {
 				// present both.
 				msg = fmt.Sprintf("%s: error=%s", msg, err)
 			}
-			err = fmt.Errorf(msg)
+			err = errors.New(msg)
 		}
 		if err != nil {
 			logrus.WithError(err).Error("Final result of CNI DEL was an error.")
@@ -586,8 +590,29 @@ func cmdDel(args *skel.CmdArgs) (err error) {
 		return
 	}
 
-	// Release the IP address by calling the configured IPAM plugin.
-	ipamErr := utils.DeleteIPAM(conf, args, logger)
+	// Release the IP address by calling the configured IPAM plugin. This doesn't depend on the endpoint or the
+	// interfaces, so do it concurrently with removing them. DeleteIPAM may rewrite the stdin data it's given, so
+	// hand it its own copy of the args.
+	ipamArgs := *args
+	ipamErrC := make(chan error, 1)
+	go func() {
+		// The recover at the top of cmdDel doesn't cover this goroutine, so convert a panic into an
+		// error here to still return a proper error to the runtime.
+		defer func() {
+			if e := recover(); e != nil {
+				ipamErrC <- fmt.Errorf("Calico CNI panicked during IPAM release: %s", e)
+			}
+		}()
+		ipamErrC <- utils.DeleteIPAM(conf, &ipamArgs, logger)
+	}()
+	defer func() {
+		// Always wait for the release to finish. Return the IPAM error if there was one. The IPAM error will be
+		// lost if there was also an error in cleaning up the device or endpoint, but crucially, the user will know
+		// the overall operation failed.
+		if ipamErr := <-ipamErrC; err == nil {
+			err = ipamErr
+		}
+	}()
 
 	// Delete the WorkloadEndpoint object from the datastore.
 	if _, err = calicoClient.WorkloadEndpoints().Delete(ctx, epIDs.Namespace, epIDs.WEPName, options.DeleteOptions{}); err != nil {
@@ -608,13 +633,6 @@ func cmdDel(args *skel.CmdArgs) (err error) {
 	}
 
 	err = d.CleanUpNamespace(args)
-	if err != nil {
-		return
-	}
-
-	// Return the IPAM error if there was one. The IPAM error will be lost if there was also an error in cleaning up
-	// the device or endpoint, but crucially, the user will know the overall operation failed.
-	err = ipamErr
 	return
 }
 
@@ -678,6 +696,10 @@ func Main(version string) {
 		os.Exit(1)
 	}
 
+	// calico-ipam is built into this binary, so call it directly rather than executing it.
+	utils.CalicoIPAMAdd = ipamplugin.CmdAddInProcess
+	utils.CalicoIPAMDel = ipamplugin.CmdDelInProcess
+
 	skel.PluginMain(cmdAdd, nil, cmdDel,
 		cniSpecVersion.PluginSupports("0.1.0", "0.2.0", "0.3.0", "0.3.1"),
 		"Calico CNI plugin "+version)
@@ -973,6 +973,50 @@ var _ = Describe("Kubernetes CNI tests", func() {
 			})
 		}
 
+		It("should return an error, rather than panicking, if a host-local route isn't a dict", func() {
+			netconfHostLocalIPAM := fmt.Sprintf(`
+				{
+				  "cniVersion": "%s",
+				  "name": "net7",
+				  "nodename_file_optional": true,
+				  "type": "calico",
+				  "etcd_endpoints": "http://%s:2379",
+				  "datastore_type": "%s",
+				  "ipam": {
+				    "type": "host-local",
+				    "subnet": "10.100.0.0/24",
+				    "routes": ["10.123.0.0/16"]
+				  },
+				  "kubernetes": {
+				    "k8s_api_root": "http://127.0.0.1:8080"
+				  },
+				  "log_level":"info"
+				}`, cniVersion, os.Getenv("ETCD_IP"), os.Getenv("DATASTORE_TYPE"))
+
+			ensureNamespace(k8sClient, testutils.K8S_TEST_NS)
+
+			name := fmt.Sprintf("run%d", rand.Uint32())
+			ensurePodCreated(k8sClient, testutils.K8S_TEST_NS, &v1.Pod{
+				ObjectMeta: metav1.ObjectMeta{Name: name},
+				Spec: v1.PodSpec{
+					Containers: []v1.Container{{
+						Name:  name,
+						Image: "ignore",
+					}},
+					NodeName: hostname,
+				},
+			})
+			defer ensurePodDeleted(k8sClient, testutils.K8S_TEST_NS, name)
+
+			_, _, _, _, _, contNs, err := testutils.CreateContainer(netconfHostLocalIPAM, name, testutils.K8S_TEST_NS, "")
+			Expect(err).To(HaveOccurred())
+			Expect(err.Error()).To(ContainSubstring("expecting each route to be a dict"))
+			Expect(err.Error()).NotTo(ContainSubstring("panicked"))
+
+			_, err = testutils.DeleteContainer(netconfHostLocalIPAM, contNs.Path(), name, testutils.K8S_TEST_NS)
+			Expect(err).ShouldNot(HaveOccurred())
+		})
+
 	})
 
 	Context("using calico-ipam with a Namespace annotation only", func() {